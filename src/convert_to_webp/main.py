@@ -1,25 +1,78 @@
+import atexit
+import contextlib
 import csv
+import functools
 import logging
+import logging.handlers
 import math
-import re
+import os
+import queue
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
-from typing import Generator
+from typing import Generator, NamedTuple
+
+try:
+    from PIL import Image, features
+
+    PIL_WEBP = features.check("webp")
+except ImportError:
+    PIL_WEBP = False
 
 QUALITY = 80
 LOSSLESS = False
+METHOD = 4
 IMAGE_EXT = [".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp"]
+IMAGE_EXT_SET = frozenset(IMAGE_EXT)
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# read once at import, os.umask can only be queried by setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)-8s | %(message)s",
     level=logging.DEBUG,
 )
-re_output_file_size = re.compile(r"[o|O]utput.+?(\d+)\sbytes")
+logging.getLogger("PIL").setLevel(logging.INFO)
+
+
+@functools.lru_cache(maxsize=1)
+def check_libwebp() -> bool:
+    return bool(shutil.which("cwebp") and shutil.which("gif2webp"))
+
+
+@contextlib.contextmanager
+def queued_logging() -> Generator[None, None, None]:
+    # emit root log records from a listener thread, flushed on exit
+    root = logging.getLogger()
+    handlers = root.handlers
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        root.handlers = handlers
+
+
+class ImageFile(NamedTuple):
+    path: str
+    dir: str
+    name: str
+    stem: str
+    suffix: str  # lower case
+    rel_dir: str  # relative to input_dir, "" for the top level
+    size: int  # bytes
+    mtime: float
 
 
 class Converter:
@@ -29,123 +82,311 @@ class Converter:
         output_dir: Path,
         quality: int = QUALITY,
         lossless: bool = LOSSLESS,
+        method: int = METHOD,
+        near_lossless: int | None = None,
+        multithread: bool = False,
+        force: bool = False,
     ) -> None:
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.quality = quality
         self.lossless = lossless
+        self.method = method
+        self.near_lossless = near_lossless
+        self.multithread = multithread
+        self.force = force
 
         self.missing = []
+        # shared by the pool threads, mkdir is idempotent so races are harmless
+        self._ensured_dirs: set[str] = set()
 
     def check_libwebp(self) -> bool:
-        return bool(shutil.which("cwebp") and shutil.which("gif2webp"))
+        return check_libwebp()
 
     def is_image(self, file: Path) -> bool:
-        return file.is_file() and (file.suffix.lower() in IMAGE_EXT)
+        return file.is_file() and (file.suffix.lower() in IMAGE_EXT_SET)
 
-    def get_output_path(self, input_path: Path) -> Path:
-        output_path = (
-            self.output_dir
-            / input_path.relative_to(self.input_dir).parent
-            / f"{input_path.stem}.webp"
-        )
-        if not output_path.parent.is_dir():
-            output_path.parent.mkdir(parents=True, exist_ok=True)
-
-        return output_path
-
-    def parse_stdout(
-        self, input_file: Path, stdout: str
-    ) -> tuple[str, str, int, int | None, float | None]:
-        file_dir, file_name = str(input_file.parent), input_file.name
-        original_size = math.ceil(
-            input_file.stat().st_size / 1024
-        )  # bytes to KB, min is 1KB
+    def get_output_path(self, image: ImageFile) -> str:
+        output_dir = os.path.join(self.output_dir, image.rel_dir)
+        if output_dir not in self._ensured_dirs:
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+            self._ensured_dirs.add(output_dir)
+
+        return os.path.join(output_dir, f"{image.stem}.webp")
+
+    def parse_result(
+        self, image: ImageFile, webp_bytes: int | None, skipped: bool = False
+    ) -> tuple[str, str, int, int | None, float | None, bool]:
+        original_size = math.ceil(image.size / 1024)  # bytes to KB, min is 1KB
         webp_size, changed_rate = None, None
-        matched = re_output_file_size.search(stdout)
-        if original_size and matched:
-            webp_size = math.ceil(int(matched.group(1)) / 1024)
+        if original_size and webp_bytes is not None:
+            webp_size = math.ceil(webp_bytes / 1024)
             changed_rate = round((webp_size - original_size) / original_size, 2)
 
-        return file_dir, file_name, original_size, webp_size, changed_rate
+        return image.dir, image.name, original_size, webp_size, changed_rate, skipped
 
-    def get_all_images(self, input_path: Path) -> Generator[Path, None, None]:
+    def get_all_images(self, input_path: Path) -> Generator[ImageFile, None, None]:
         if input_path.is_file() and self.is_image(input_path):
-            yield input_path
+            stat = input_path.stat()
+            yield ImageFile(
+                str(input_path),
+                str(input_path.parent),
+                input_path.name,
+                input_path.stem,
+                input_path.suffix.lower(),
+                "",
+                stat.st_size,
+                stat.st_mtime,
+            )
         elif input_path.is_dir():
-            for i in self.input_dir.glob("**/*"):
-                if self.is_image(i):
-                    yield i
-                elif i.is_file():
-                    self.missing.append(str(i))
+            # scandir reuses the file type from the directory listing, no stat per entry
+            stack = [(str(input_path), "")]
+            # the output may sit inside the input tree, don't convert our own webp
+            output_dir = os.path.realpath(self.output_dir)
+            while stack:
+                dir_path, rel_dir = stack.pop()
+                try:
+                    it = os.scandir(dir_path)
+                except PermissionError:
+                    logging.warning(f"Skipped unreadable directory {dir_path}")
+                    continue
+                with it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            if os.path.realpath(entry.path) == output_dir:
+                                continue
+                            stack.append(
+                                (entry.path, os.path.join(rel_dir, entry.name))
+                            )
+                            continue
+                        if not entry.is_file():
+                            continue
+
+                        stem, suffix = os.path.splitext(entry.name)
+                        suffix = suffix.lower()
+                        if suffix in IMAGE_EXT_SET:
+                            # DirEntry caches its stat, free on Windows
+                            stat = entry.stat()
+                            yield ImageFile(
+                                entry.path,
+                                dir_path,
+                                entry.name,
+                                stem,
+                                suffix,
+                                rel_dir,
+                                stat.st_size,
+                                stat.st_mtime,
+                            )
+                        else:
+                            self.missing.append(entry.path)
+
+    def _encode_webp(self, image: ImageFile, output_file: str) -> bool:
+        try:
+            with Image.open(image.path) as im:
+                im.save(
+                    output_file,
+                    "WEBP",
+                    save_all=getattr(im, "is_animated", False),
+                    quality=self.quality,
+                    lossless=self.lossless,
+                    method=self.method,
+                )
+        except (OSError, ValueError):
+            return False
 
-    def convert(
-        self, input_file: Path
-    ) -> tuple[str, str, int, int | None, float | None]:
-        output_file = self.get_output_path(input_file)
+        return True
 
-        cli = "gif2webp" if input_file.suffix.lower() == ".gif" else "cwebp"
-        command = [cli, "-q", str(self.quality)]
+    def _encode_cwebp(
+        self, image: ImageFile, output_file: str, multithread: bool
+    ) -> bool:
+        cli = "gif2webp" if image.suffix == ".gif" else "cwebp"
+        command = [cli, "-q", str(self.quality), "-m", str(self.method)]
         if self.lossless and cli == "cwebp":
             command.append("-lossless")
         if not self.lossless and cli == "gif2webp":
             command.append("-lossy")
-        command += ["-o", output_file, "--", input_file]
+        if self.near_lossless is not None and cli == "cwebp":
+            command += ["-near_lossless", str(self.near_lossless)]
+        if self.multithread or multithread:
+            command.append("-mt")
+        command += ["-o", output_file, "--", image.path]
 
         result = subprocess.run(
-            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
         )
 
-        return self.parse_stdout(input_file, result.stdout.decode())
+        return result.returncode == 0
+
+    def use_pillow(self) -> bool:
+        # Pillow has no near-lossless option
+        return PIL_WEBP and self.near_lossless is None
+
+    def convert(
+        self, image: ImageFile, multithread: bool = False
+    ) -> tuple[str, str, int, int | None, float | None, bool]:
+        output_file = self.get_output_path(image)
+
+        # reuse an output that is newer than its input from a previous run
+        if not self.force:
+            try:
+                output_stat = os.stat(output_file)
+            except OSError:
+                pass
+            else:
+                if output_stat.st_mtime >= image.mtime:
+                    return self.parse_result(image, output_stat.st_size, True)
+
+        # encode to a temporary file so an interrupted run never leaves a
+        # truncated webp that looks up to date, unique per call since inputs
+        # with the same stem share an output file
+        fd, tmp_file = tempfile.mkstemp(
+            prefix=f"{image.stem}.",
+            suffix=".webp.tmp",
+            dir=os.path.dirname(output_file),
+        )
+        os.close(fd)
+        try:
+            if self.use_pillow():
+                try:
+                    converted = self._encode_webp(image, tmp_file)
+                except Image.DecompressionBombError:
+                    # over Pillow's pixel limit, leave it to cwebp if available
+                    converted = self.check_libwebp() and self._encode_cwebp(
+                        image, tmp_file, multithread
+                    )
+            else:
+                converted = self._encode_cwebp(image, tmp_file, multithread)
+            if converted:
+                os.chmod(tmp_file, 0o666 & ~UMASK)  # mkstemp creates it 0600
+                os.replace(tmp_file, output_file)
+        except OSError:
+            converted = False
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_file)
+
+        webp_bytes = os.stat(output_file).st_size if converted else None
+        return self.parse_result(image, webp_bytes)
+
+    def convert_all(
+        self,
+    ) -> Generator[tuple[str, str, int, int | None, float | None, bool], None, None]:
+        # scan the tree in a background thread so encoding starts right away,
+        # results are yielded in completion order
+        workers = os.cpu_count() or 1
+        images = queue.Queue(maxsize=4 * workers)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=_produce,
+            args=(self.get_all_images(self.input_dir), images, stop),
+            daemon=True,
+        )
+        producer.start()
+
+        executor = get_executor()
+        pending = set()
+        try:
+            while (image := images.get()) is not None:
+                if isinstance(image, BaseException):
+                    raise image
+                pending.add(executor.submit(self.convert, image))
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+            for future in as_completed(pending):
+                pending.discard(future)
+                yield future.result()
+        finally:
+            # on failure or an abandoned generator, stop scanning and queued work
+            stop.set()
+            for future in pending:
+                future.cancel()
+            producer.join()
 
     def main(self) -> None:
-        if not self.check_libwebp():
-            sys.exit("Please install `libwebp` first!")
+        if not self.use_pillow() and not self.check_libwebp():
+            if PIL_WEBP:
+                sys.exit("Please install `libwebp` for near-lossless encoding!")
+            sys.exit("Please install `Pillow` or `libwebp` first!")
 
         started_at = time.monotonic()
-        count = 0
+        # reset state from a previous call, the output tree may have changed too
+        self._ensured_dirs.clear()
+        self.missing.clear()
 
-        images = self.get_all_images(self.input_dir)
-        failed, bigger = [], []
+        rows = []
 
-        headers = ["dir", "file", "original(KB)", "webp(KB)", "changed"]
+        headers = ["dir", "file", "original(KB)", "webp(KB)", "changed", "skipped"]
         converted_details = self.output_dir / "details.csv"
         missing_files = self.output_dir / "missing.csv"
         if not self.output_dir.is_dir():
             self.output_dir.mkdir(parents=True)
 
-        with (
-            ProcessPoolExecutor() as executor,
-            open(converted_details, "w", encoding="utf8", newline="") as f,
-            open(missing_files, "w", encoding="utf8") as m,
-        ):
-            writer = csv.DictWriter(f, fieldnames=headers)
-            writer.writeheader()
-
-            for result in executor.map(self.convert, images):
-                writer.writerow(dict(zip(headers, result)))
-                count += 1
-
-                file_dir, file_name, original_size, webp_size, changed_rate = result
-                logging.info(
-                    f"{file_dir}/{file_name}"
-                    f"| {original_size:>5} KB"
-                    + (
-                        f"| {webp_size:>5} KB| {changed_rate:>5.0%}"
-                        if webp_size
-                        else "|"
-                    )
-                )
-
-                if changed_rate is None:
-                    failed.append(f"{file_dir}/{file_name}")
-                    count -= 1
-                elif changed_rate > 1:
-                    bigger.append(f"{file_dir}/{file_name}")
-
-            # write not converted files
-            for i in self.missing:
-                m.write(i)
+        # a single image is converted inline, without starting the pool,
+        # so cwebp may use the otherwise idle cores
+        if self.input_dir.is_file():
+            results = [
+                self.convert(i, multithread=True)
+                for i in self.get_all_images(self.input_dir)
+            ]
+        else:
+            results = self.convert_all()
+
+        try:
+            with queued_logging():
+                log_info = logging.getLogger().isEnabledFor(logging.INFO)
+                for result in results:
+                    rows.append(result)
+
+                    (
+                        file_dir,
+                        file_name,
+                        original_size,
+                        webp_size,
+                        changed_rate,
+                        skipped,
+                    ) = result
+                    if log_info and webp_size:
+                        logging.info(
+                            "%s/%s| %5d KB| %5d KB| %4.0f%%%s",
+                            file_dir,
+                            file_name,
+                            original_size,
+                            webp_size,
+                            changed_rate * 100,
+                            "| skipped, up to date" if skipped else "",
+                        )
+                    elif log_info:
+                        logging.info(
+                            "%s/%s| %5d KB|", file_dir, file_name, original_size
+                        )
+        finally:
+            # written even when the run is interrupted, with the rows so far
+            with (
+                open(
+                    converted_details,
+                    "w",
+                    buffering=WRITE_BUFFER_SIZE,
+                    encoding="utf8",
+                    newline="",
+                ) as f,
+                open(
+                    missing_files, "w", buffering=WRITE_BUFFER_SIZE, encoding="utf8"
+                ) as m,
+            ):
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                writer.writerows(rows)
+
+                # write not converted files
+                m.write("".join(f"{i}\n" for i in self.missing))
+
+        failed = [f"{r[0]}/{r[1]}" for r in rows if r[4] is None]
+        bigger = [f"{r[0]}/{r[1]}" for r in rows if r[4] is not None and r[4] > 1]
+        skip_count = sum(1 for r in rows if r[5])
+        count = len(rows) - len(failed) - skip_count
 
         if bigger or failed:
             print(f"{'=' * 20} WARNING {'=' * 20}")
@@ -156,10 +397,50 @@ class Converter:
 
         print(f"{'=' * 20} Result {'=' * 20}")
         logging.info(f"Converted: {count}, Cost: {time.monotonic() - started_at:.2f}s")
+        if skip_count:
+            logging.info(
+                f"Skipped: {skip_count} already up to date, "
+                "use --force to convert them again"
+            )
         logging.info(f"View all details in {converted_details.resolve()}")
         logging.info(f"View not converted files in {missing_files.resolve()}")
 
 
+def _put(out: queue.Queue, item, stop: threading.Event) -> bool:
+    # a bounded put that gives up once the consumer has stopped
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+        except queue.Full:
+            continue
+        return True
+    return False
+
+
+def _produce(
+    images: Generator[ImageFile, None, None], out: queue.Queue, stop: threading.Event
+) -> None:
+    try:
+        for image in images:
+            if not _put(out, image, stop):
+                return
+    except BaseException as e:
+        _put(out, e, stop)
+    else:
+        _put(out, None, stop)
+    finally:
+        images.close()  # closes the open scandir iterator
+
+
+@functools.lru_cache(maxsize=1)
+def get_executor() -> ThreadPoolExecutor:
+    if PIL_WEBP:
+        Image.init()  # load image plugins up front, not in every thread's first open
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+    atexit.register(executor.shutdown)
+    return executor
+
+
 def cli():
     import argparse
 
@@ -184,6 +465,34 @@ def cli():
         action="store_true",
         help="encode image losslessly, default=False",
     )
+    parser.add_argument(
+        "-m",
+        "--method",
+        type=int,
+        default=METHOD,
+        choices=range(7),
+        help=f"compression method, 0=fast, 6=slowest, default={METHOD}",
+    )
+    parser.add_argument(
+        "--near-lossless",
+        type=int,
+        choices=range(101),
+        metavar="{0-100}",
+        help="near-lossless preprocessing level, 0=max, 100=off, "
+        "forces lossless encoding, requires cwebp",
+    )
+    parser.add_argument(
+        "--mt",
+        dest="multithread",
+        action="store_true",
+        help="use multi-threading for each cwebp encode, default=False",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="convert images whose webp is already up to date, default=False",
+    )
     args = parser.parse_args()
 
     converter = Converter(
@@ -191,6 +500,10 @@ def cli():
         output_dir=args.out_dir,
         quality=args.quality,
         lossless=args.lossless,
+        method=args.method,
+        near_lossless=args.near_lossless,
+        multithread=args.multithread,
+        force=args.force,
     )
     converter.main()
 